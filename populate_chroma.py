@@ -1,5 +1,7 @@
 import json
 import os
+import shelve
+import hashlib
 from openai import OpenAI
 import chromadb
 from dotenv import load_dotenv
@@ -14,6 +16,23 @@ if not OPENAI_API_KEY:
     raise ValueError("OPENAI_API_KEY not found in .env file.")
 client = OpenAI(api_key=OPENAI_API_KEY) # <--- CORRECTED: Changed api_api_key to api_key
 
+# Must match the model/dimensions used for query embeddings in app.py.
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIMENSIONS = 512
+
+# The embeddings endpoint accepts arrays of inputs; embedding 128 texts per
+# call turns N serial HTTP round-trips into N/128.
+EMBEDDING_BATCH_SIZE = 128
+
+# Local cache of computed embeddings so re-running the script (deploy, schema
+# tweak) only pays OpenAI for products whose text actually changed.
+EMBEDDING_CACHE_PATH = "./emb_cache"
+
+def embedding_cache_key(text):
+    """Cache key for an embedding text; includes model/dims so a model or
+    dimension change never serves stale vectors."""
+    return hashlib.sha256(f"{EMBEDDING_MODEL}:{EMBEDDING_DIMENSIONS}:{text}".encode("utf-8")).hexdigest()
+
 # ChromaDB setup
 chroma_client = chromadb.PersistentClient(path="./chroma_db")
 collection_name = "apparel_products"
@@ -32,27 +51,31 @@ except Exception as e:
 # Get or create the collection
 collection = chroma_client.get_or_create_collection(name=collection_name)
 
-def get_embedding(text):
-    """Generates an embedding for the given text using OpenAI's API."""
-    try:
-        response = client.embeddings.create(input=[text], model="text-embedding-3-small")
-        return response.data[0].embedding
-    except Exception as e:
-        print(f"Error getting embedding for text: '{text[:50]}...' - {e}")
-        traceback.print_exc()
-        return None
+# Every metadata field stored per product, in storage order.
+METADATA_FIELDS = (
+    "id", "name", "price", "image_url", "product_url", "category", "gender",
+    "occasion_tags", "style_tags", "color", "short_description",
+    "master_category", "subcategory", "season", "sleeve_length", "item_length"
+)
+
+def get_embeddings_batch(texts):
+    """Generates embeddings for a batch of texts in a single OpenAI API call."""
+    response = client.embeddings.create(input=texts, model=EMBEDDING_MODEL, dimensions=EMBEDDING_DIMENSIONS)
+    return [item.embedding for item in response.data]
 
 def populate_chroma_db(json_file_path):
     """Reads products from a JSON file and populates ChromaDB."""
     with open(json_file_path, 'r', encoding='utf-8') as f:
         products = json.load(f)
 
-    ids = []
-    documents = []
-    embeddings_list = []
-    metadatas = []
+    # Preallocate and assign by index: no O(N) list-growth reallocations, and
+    # every product keeps the same slot across all four parallel lists.
+    n = len(products)
+    ids = [None] * n
+    documents = [None] * n
+    metadatas = [None] * n
 
-    print(f"Processing {len(products)} products from {json_file_path}...")
+    print(f"Processing {n} products from {json_file_path}...")
 
     for i, product in enumerate(products):
         product_id = product.get("id")
@@ -60,52 +83,63 @@ def populate_chroma_db(json_file_path):
         short_description = product.get("short_description", "")
 
         embedding_text = f"{name}. {short_description}"
-        embedding = get_embedding(embedding_text)
-
-        if embedding is None:
-            print(f"Skipping product {product_id} due to embedding error.")
-            continue
 
-        # --- Extract ALL metadata fields and convert lists to strings ---
+        # Tag lists become comma-separated strings before the metadata build
         occasion_tags = product.get("occasion_tags")
         if isinstance(occasion_tags, list):
-            occasion_tags = ", ".join(occasion_tags) # Convert list to comma-separated string
-        
+            occasion_tags = ", ".join(occasion_tags)
+
         style_tags = product.get("style_tags")
         if isinstance(style_tags, list):
-            style_tags = ", ".join(style_tags) # Convert list to comma-separated string
+            style_tags = ", ".join(style_tags)
 
-        metadata = {
+        # Fields whose values differ from a plain product.get lookup
+        prepared_values = {
             "id": product_id,
             "name": name,
-            "price": product.get("price"),
-            "image_url": product.get("image_url"),
-            "product_url": product.get("product_url"),
-            "category": product.get("category"),
-            "gender": product.get("gender"),
-            "occasion_tags": occasion_tags, # Now a string
-            "style_tags": style_tags,     # Now a string
-            "color": product.get("color"),
             "short_description": short_description,
-            # --- NEW FIELDS ---
-            "master_category": product.get("master_category"),
-            "subcategory": product.get("subcategory"),
-            "season": product.get("season"),
-            "sleeve_length": product.get("sleeve_length"),
-            "item_length": product.get("item_length")
+            "occasion_tags": occasion_tags,
+            "style_tags": style_tags,
         }
-        
-        # Filter out None values. "N/A" strings will be kept.
-        metadata = {k: v for k, v in metadata.items() if v is not None}
 
+        # Single-pass build that drops None values ("N/A" strings are kept),
+        # instead of constructing the full dict and re-walking it to filter.
+        metadata = {
+            k: v for k, v in (
+                (k, prepared_values.get(k, product.get(k))) for k in METADATA_FIELDS
+            ) if v is not None
+        }
 
-        ids.append(product_id)
-        documents.append(embedding_text)
-        embeddings_list.append(embedding)
-        metadatas.append(metadata)
-
-        if (i + 1) % 10 == 0:
-            print(f"Processed {i+1} products...")
+        ids[i] = product_id
+        documents[i] = embedding_text
+        metadatas[i] = metadata
+
+    # Embed in batches, consulting the persistent cache first: a re-run with
+    # unchanged product text makes zero API calls.
+    embeddings_list = [None] * n
+    with shelve.open(EMBEDDING_CACHE_PATH) as cache:
+        cache_keys = [embedding_cache_key(text) for text in documents]
+        miss_indices = []
+        for idx, key in enumerate(cache_keys):
+            cached = cache.get(key)
+            if cached is not None:
+                embeddings_list[idx] = cached
+            else:
+                miss_indices.append(idx)
+        print(f"Embedding cache: {len(documents) - len(miss_indices)} hits, {len(miss_indices)} misses.")
+
+        for start in range(0, len(miss_indices), EMBEDDING_BATCH_SIZE):
+            chunk_indices = miss_indices[start:start + EMBEDDING_BATCH_SIZE]
+            try:
+                chunk_embeddings = get_embeddings_batch([documents[i] for i in chunk_indices])
+            except Exception as e:
+                print(f"Error embedding batch starting at miss {start}: {e}")
+                traceback.print_exc()
+                return
+            for idx, embedding in zip(chunk_indices, chunk_embeddings):
+                embeddings_list[idx] = embedding
+                cache[cache_keys[idx]] = embedding
+            print(f"Embedded {min(start + EMBEDDING_BATCH_SIZE, len(miss_indices))}/{len(miss_indices)} uncached products...")
 
     # Add to collection
     try: